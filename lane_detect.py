@@ -1,7 +1,17 @@
 import sys
+import argparse
+import functools
+import threading
 import numpy as np
 import cv2
 
+from queue import Queue, Full
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 '''
 :Author Vignesh Ungrapalli
 A basic lane detection program with line detection in Hough Space and a simple line fitting.
@@ -20,7 +30,28 @@ MIN_VOTES       = 20
 MIN_LINE_LENGTH = 20
 MAX_LINE_GAP    = 5
 
+# Frames are downscaled by this factor before preprocessing and Hough transform
+SCALE = 2
+
 FRAME_DELAY = 25
+# Process every STRIDE-th frame only. Skipped frames are never decoded, use 2+ when CPU-bound
+STRIDE      = 1
+# Number of decoded frames buffered ahead of processing
+QUEUE_SIZE  = 4
+
+# Lanes change slowly, run the Hough transform only every HOUGH_INTERVAL-th frame as long as the
+# edge image still has MIN_LANE_EDGES pixels in a LANE_WINDOW wide window along both lanes
+HOUGH_INTERVAL = 5
+MIN_LANE_EDGES = 30
+LANE_WINDOW    = 5
+# Weight of the newly fitted lane in the moving average of lane slope and intercept
+LANE_ALPHA     = 0.6
+
+# Decode the video on hardware when possible, falls back to software decoding
+HW_DECODE = 1
+# GStreamer pipeline for NVDEC decoding of H.264 mp4 files, {} is the video file
+GST_PIPELINE = ('filesrc location="{}" ! qtdemux ! h264parse ! nvv4l2decoder ! nvvidconv ! '
+                'video/x-raw, format=BGRx ! videoconvert ! video/x-raw, format=BGR ! appsink max-buffers=2')
 
 YELLOW_LOW  = np.asarray([20, 100, 100]) 
 YELLOW_HIGH = np.asarray([30, 255, 255])
@@ -28,25 +59,37 @@ WHITE_LOW   = np.asarray([0, 0, 230])
 WHITE_HIGH  = np.asarray([255, 80, 255])
 
 DUMP = 1 
-
-
-def get_slope(x1, y1, x2, y2):
-    '''
-    Get slope of line
-    
-    :param x1, y1, x2, y2: 4 scalars with (x1,y1) and (x2,y2) as points
-
-    :ret dy/dx : slope of the line represented by thr two points
-    :ret None: In case there is a divide by zero
-    '''
-
-    if x2 != x1:
-        dy = float(y2) - float(y1)
-        dx = float(x2) - float(x1)
-
-        return dy/dx
-    else:
-        return None
+# Show the edge image in a separate window
+SHOW_EDGES = 1
+# Color thresholding runs on the first enabled and available of: the G-API graph (USE_GAPI), the numba
+# kernel threshold_v (USE_NUMBA_THRESHOLD) and plain OpenCV calls. Only the path that is used gets compiled.
+# Run preprocessing as an OpenCV G-API graph when available (OpenCV 4.x). Off by default: the graph
+# returns a newly allocated edge image every frame instead of reusing the preprocessing buffers, and it
+# has not been measured to be faster than the plain OpenCV path at this frame size.
+USE_GAPI = 0
+# Threshold colors with the numba kernel threshold_v. Off by default: it was measured 20-50% slower than
+# the OpenCV calls it replaces on a single thread.
+USE_NUMBA_THRESHOLD = 0
+# Run preprocessing and Hough transform on the GPU when OpenCV has CUDA support and a device is present
+USE_CUDA = 1
+
+# Hough thresholds for the downscaled edge image, shared by the CPU and CUDA paths. HoughLinesP rounds
+# line length and gap to integers itself, the CUDA detector only takes integers.
+_hough_votes      = MIN_VOTES // SCALE
+_hough_min_length = int(round(MIN_LINE_LENGTH / SCALE))
+_hough_max_gap    = int(round(MAX_LINE_GAP / SCALE))
+
+# Color thresholds as scalars for G-API and CUDA
+_thresholds = tuple(tuple(float(t) for t in thresh) for thresh in (YELLOW_LOW, YELLOW_HIGH, WHITE_LOW, WHITE_HIGH))
+
+# Preprocessing buffers, keyed by (downscaled) frame (height, width)
+_bufs = {}
+# Current lanes as returned by fit_line and the number of frames processed
+_lane_state = {'right': None, 'left': None, 'age': 0}
+
+# Scratch point buffers for the line classifier, reused across frames
+_right_pts = np.empty((1024, 2), np.int32)
+_left_pts  = np.empty((1024, 2), np.int32)
 
 
 def get_line_props(line):
@@ -59,7 +102,7 @@ def get_line_props(line):
     :ret m,c: slope and intercept of the line passing through (x1,y1) and (x2,y2)
     '''
 
-    if line[0] is not 0:
+    if line[0] != 0:
         m = (float(line[1])/line[0])
         c = float(line[3]) - (m * line[2])
     else:
@@ -83,57 +126,192 @@ def get_x(y, lane):
     
     m, c = get_line_props(lane)
 
-    if m is not 0 and not None:
+    if m is not None and m != 0:
         return ((y-c)/m)
     else:
         return None
 
 
-def color_threshold(frame_in, frame_hsv):
+def get_buffers(frame_h, frame_w):
+    '''
+    Get the buffers preprocessing writes its intermediate images to. They are allocated once per frame
+    size and reused, so no image is allocated per frame.
+
+    :param frame_h: Height of the (downscaled) frame
+    :param frame_w: Width of the (downscaled) frame
+
+    :ret bufs: A dict of uint8 arrays, 'small' and 'hsv' with 3 channels, 'yellow_mask', 'white_mask',
+               'grey', 'edge' and 'window' with 1 channel
+    '''
+
+    bufs = _bufs.get((frame_h, frame_w))
+    if bufs is None:
+        bufs = {
+            'small':       np.empty((frame_h, frame_w, 3), np.uint8),
+            'hsv':         np.empty((frame_h, frame_w, 3), np.uint8),
+            'yellow_mask': np.empty((frame_h, frame_w), np.uint8),
+            'white_mask':  np.empty((frame_h, frame_w), np.uint8),
+            'grey':        np.empty((frame_h, frame_w), np.uint8),
+            'edge':        np.empty((frame_h, frame_w), np.uint8),
+            'window':      np.empty((frame_h, frame_w), np.uint8),
+        }
+        _bufs[(frame_h, frame_w)] = bufs
+
+    return bufs
+
+
+def threshold_v(frame_hsv, yellow_low, yellow_high, white_low, white_high, threshold):
+    '''
+    Color thresholding of the V channel in a single pass over the frame, same result as color_threshold.
+    Only used compiled with numba. It runs single threaded like OpenCV, see cv2.setNumThreads in main.
+
+    :param frame_hsv: Input frame in hsv space
+    :param yellow_low, yellow_high, white_low, white_high: HSV thresholds
+    :param threshold: Output buffer for the thresholded V channel
+    '''
+
+    for i in range(frame_hsv.shape[0]):
+        for j in range(frame_hsv.shape[1]):
+            h = frame_hsv[i, j, 0]
+            s = frame_hsv[i, j, 1]
+            v = frame_hsv[i, j, 2]
+
+            yellow = (yellow_low[0] <= h <= yellow_high[0] and yellow_low[1] <= s <= yellow_high[1]
+                      and yellow_low[2] <= v <= yellow_high[2])
+            white  = (white_low[0] <= h <= white_high[0] and white_low[1] <= s <= white_high[1]
+                      and white_low[2] <= v <= white_high[2])
+
+            threshold[i, j] = v if yellow or white else 0
+
+
+def color_threshold(frame_hsv, bufs):
     '''
     Color thresholding on the input image. Black out the pixels which do not fall in the 
-    range of yellow and white thresholds
+    range of yellow and white thresholds. Only the V channel is kept, H and S are not needed
+    for edge detection.
 
-    :param frame_in: Input frame
     :param frame_hsv: Input frame in hsv space
+    :param bufs: Preprocessing buffers, see get_buffers
 
-    :ret threshold: The thresholded frame 
+    :ret threshold: The thresholded V channel
     '''
 
-    yellow_mask = cv2.inRange(frame_hsv, YELLOW_LOW, YELLOW_HIGH)
-    white_mask  = cv2.inRange(frame_hsv, WHITE_LOW, WHITE_HIGH)
-    mask = cv2.bitwise_or(yellow_mask, white_mask)
-    threshold = cv2.bitwise_and(frame_in, frame_in, mask=mask)
+    if _numba_threshold:
+        threshold = bufs['grey']
+        threshold_v(frame_hsv, YELLOW_LOW, YELLOW_HIGH, WHITE_LOW, WHITE_HIGH, threshold)
+        return threshold
+
+    yellow_mask = cv2.inRange(frame_hsv, YELLOW_LOW, YELLOW_HIGH, dst=bufs['yellow_mask'])
+    white_mask  = cv2.inRange(frame_hsv, WHITE_LOW, WHITE_HIGH, dst=bufs['white_mask'])
+    mask = cv2.bitwise_or(yellow_mask, white_mask, dst=yellow_mask)
+    threshold = cv2.extractChannel(frame_hsv, 2, dst=bufs['grey'])
+    # The mask is 0 or 255, so AND-ing with it blacks out the pixels. A masked bitwise_and would leave
+    # them unchanged in the preallocated buffer.
+    cv2.bitwise_and(threshold, mask, dst=threshold)
     # cv2.imshow('',threshold)
 
     return threshold
 
 
+@functools.lru_cache(maxsize=None)
+def get_roi_mask(frame_h, frame_w):
+    '''
+    Get the mask carving out unnecessary region in the frame. The mask only depends on the frame
+    dimensions, so it is built once per frame size and cached.
+
+    :param frame_h: Height of the (downscaled) frame
+    :param frame_w: Width of the (downscaled) frame
+
+    :ret mask: uint8 mask which is 255 in the region of interest and 0 elsewhere
+    '''
+
+    mask = np.full((frame_h, frame_w), 255, np.uint8)
+    offset = 25 // SCALE
+    pts = np.array([[(0,0), (0, frame_h), (frame_w//2 - offset, frame_h//2 + offset), (frame_w//2 + offset, frame_h//2 + offset), (frame_w, frame_h), (frame_w, 0)]])
+    cv2.fillPoly(mask, pts, 0)
+
+    return mask
+
+
+def build_preprocess_graph():
+    '''
+    Build color thresholding and edge detection as a G-API graph. G-API plans the execution of the
+    whole graph, so intermediate planes stay in cache instead of making a round trip per operation.
+
+    :ret comp, args: The compiled graph (input frame and thresholds in, edge image out) and its compile args
+    :ret None, None: In case G-API is not enabled, not available or the graph does not compile
+    '''
+
+    if not USE_GAPI or not hasattr(cv2, 'GComputation'):
+        return None, None
+
+    try:
+        g_in = cv2.GMat()
+        g_yellow_low, g_yellow_high = cv2.GScalar(), cv2.GScalar()
+        g_white_low, g_white_high   = cv2.GScalar(), cv2.GScalar()
+
+        g_hsv = cv2.gapi.RGB2HSV(cv2.gapi.BGR2RGB(g_in))
+        g_yellow_mask = cv2.gapi.inRange(g_hsv, g_yellow_low, g_yellow_high)
+        g_white_mask  = cv2.gapi.inRange(g_hsv, g_white_low, g_white_high)
+        g_mask = cv2.gapi.bitwise_or(g_yellow_mask, g_white_mask)
+        g_grey = cv2.gapi.mask(cv2.gapi.split3(g_hsv)[2], g_mask)
+        g_edge = cv2.gapi.Canny(g_grey, 50, 150, 3)
+
+        comp = cv2.GComputation(cv2.GIn(g_in, g_yellow_low, g_yellow_high, g_white_low, g_white_high),
+                                cv2.GOut(g_edge))
+        args = cv2.gapi.compile_args(cv2.gapi.core.fluid.kernels())
+
+        # G-API compiles the graph on the first apply, run it once so that missing kernels show up here
+        comp.apply(cv2.gin(np.zeros((8, 8, 3), np.uint8), *_thresholds), args=args)
+    except (AttributeError, cv2.error):
+        return None, None
+
+    return comp, args
+
+
+_preprocess_graph, _preprocess_args = build_preprocess_graph()
+
+# The numba kernel only runs when enabled and the G-API graph is not used
+_numba_threshold = bool(USE_NUMBA_THRESHOLD and njit is not None and _preprocess_graph is None)
+if _numba_threshold:
+    threshold_v = njit(cache=True)(threshold_v)
+    # Compile now, so that the first frame does not pay for it
+    threshold_v(np.zeros((1, 1, 3), np.uint8), YELLOW_LOW, YELLOW_HIGH, WHITE_LOW, WHITE_HIGH, np.zeros((1, 1), np.uint8))
+
+
 def preprocess_image(frame_in):
     '''
     Do some preprocessing on the input frame. Discard not needed colors (Lane lines are mostly white or yellow).
     Get the edge image and carve out unnecessary region in the frame. Note that the carve out region depends on
-    the placement of camera.
+    the placement of camera. Color thresholding uses the G-API graph if enabled and available, else the numba
+    kernel if enabled and installed, else plain OpenCV.
 
     :param frame_in: Input frame
 
-    :ret frame_edge: preprocessed frame
+    :ret frame_edge: preprocessed frame, downscaled by SCALE
     '''
 
-    frame_h = frame_in.shape[0] 
-    frame_w = frame_in.shape[1]
-    
-    frame_hsv = cv2.cvtColor(frame_in, cv2.COLOR_BGR2HSV)
-    frame_thresholded = color_threshold(frame_in, frame_hsv) 
-    frame_hsv = cv2.split(frame_thresholded)
-    frame_grey = frame_hsv[2]
+    # Non contiguous input would make OpenCV decline its vectorized code paths
+    frame_in = np.ascontiguousarray(frame_in, np.uint8)
+    frame_h = frame_in.shape[0] // SCALE
+    frame_w = frame_in.shape[1] // SCALE
+    bufs = get_buffers(frame_h, frame_w)
+
+    # Lane lines survive downscaling, every step below is linear in the number of pixels
+    if SCALE != 1:
+        frame_in = cv2.resize(frame_in, (frame_w, frame_h), dst=bufs['small'], interpolation=cv2.INTER_AREA)
     
+    if _preprocess_graph is not None:
+        frame_edge = _preprocess_graph.apply(cv2.gin(frame_in, *_thresholds), args=_preprocess_args)
+    else:
+        frame_hsv = cv2.cvtColor(frame_in, cv2.COLOR_BGR2HSV, dst=bufs['hsv'])
+        frame_grey = color_threshold(frame_hsv, bufs)
+        frame_edge = cv2.Canny(frame_grey, 50, 150, edges=bufs['edge'], apertureSize=3)
+
     # Carve out unnecessary region in the frame
-    pts = np.array([[(0,0), (0, frame_h), (frame_w/2 - 25, frame_h/2 + 25), (frame_w/2 + 25, frame_h/2 + 25), (frame_w, frame_h), (frame_w, 0)]])
-    cv2.fillPoly(frame_grey, pts, 0)
-    
-    frame_edge = cv2.Canny(frame_grey, 50, 150, apertureSize=3)
-    cv2.imshow('w', frame_edge)
+    cv2.bitwise_and(frame_edge, get_roi_mask(frame_h, frame_w), dst=frame_edge)
+    if SHOW_EDGES:
+        cv2.imshow('w', frame_edge)
     
     return frame_edge
 
@@ -145,44 +323,568 @@ def get_line_list(frame_in):
     :param frame_in: Input frame
 
     :ret lines_list: A list of Lines (in terms of  point coordinates)
+    :ret None: In case no lines were found
     '''
 
-    lines_list = cv2.HoughLinesP(frame_in, RHO_ACCURACY, THETA_ACCURACY, MIN_VOTES, MIN_LINE_LENGTH, MAX_LINE_GAP)
+    # Thresholds are given in original frame pixels, the edge image is downscaled
+    lines_list = cv2.HoughLinesP(frame_in, RHO_ACCURACY, THETA_ACCURACY, _hough_votes,
+                                 _hough_min_length, _hough_max_gap)
+    if lines_list is None:
+        return None
     # omit the first dimension
     lines_list = np.squeeze(lines_list, 1)
 
     return lines_list
 
 
-def process_lines(lines_list):
+def build_cuda_detectors():
     '''
-    Distinguish points into rigth lane, left lane and neither(ignore)
+    Create the CUDA edge and line segment detectors, so that preprocessing and the Hough transform run on the GPU.
 
-    :param lines_list: A list of lines represented by two points. Basically the output of cv2.HoughLinesP
+    :ret cuda: A dict with the 'canny' and 'hough' detectors, the 'stream' to run on, the 'frame' upload buffer
+               and the GPU buffers ('bufs', keyed by frame (height, width), see get_cuda_buffers)
+    :ret None: In case OpenCV has no CUDA support or there is no CUDA device
+    '''
 
-    :ret right_lane, left_lane: Two lists. One containing the points forming the right lane and other the left lane
+    if not USE_CUDA or not hasattr(cv2, 'cuda'):
+        return None
+
+    try:
+        if cv2.cuda.getCudaEnabledDeviceCount() == 0:
+            return None
+
+        hough = cv2.cuda.createHoughSegmentDetector(RHO_ACCURACY, THETA_ACCURACY, _hough_min_length, _hough_max_gap)
+        if hasattr(hough, 'setThreshold'):
+            hough.setThreshold(_hough_votes)
+
+        return {
+            'canny':  cv2.cuda.createCannyEdgeDetector(50, 150, 3),
+            'hough':  hough,
+            'stream': cv2.cuda_Stream(),
+            'frame':  cv2.cuda_GpuMat(),
+            'bufs':   {},
+        }
+    except cv2.error:
+        return None
+
+
+_cuda = build_cuda_detectors()
+
+
+def get_cuda_buffers(frame_h, frame_w):
     '''
-    
-    right_lane = []
-    left_lane  = []
+    Get the GPU buffers the CUDA path writes its intermediate images to, allocated once per frame size.
+    Same as get_buffers, but in GPU memory.
+
+    :param frame_h: Height of the (downscaled) frame
+    :param frame_w: Width of the (downscaled) frame
+
+    :ret bufs: A dict of GpuMats, 'small' and 'hsv' with 3 channels, 'planes' with the 3 HSV planes,
+               'yellow_mask', 'white_mask', 'edge' and the region of interest mask 'roi' with 1 channel,
+               and 'lines' for the detected lines
+    '''
+
+    bufs = _cuda['bufs'].get((frame_h, frame_w))
+    if bufs is None:
+        bufs = {
+            'small':       cv2.cuda_GpuMat(frame_h, frame_w, cv2.CV_8UC3),
+            'hsv':         cv2.cuda_GpuMat(frame_h, frame_w, cv2.CV_8UC3),
+            'planes':      [cv2.cuda_GpuMat(frame_h, frame_w, cv2.CV_8UC1) for _ in range(3)],
+            'yellow_mask': cv2.cuda_GpuMat(frame_h, frame_w, cv2.CV_8UC1),
+            'white_mask':  cv2.cuda_GpuMat(frame_h, frame_w, cv2.CV_8UC1),
+            'edge':        cv2.cuda_GpuMat(frame_h, frame_w, cv2.CV_8UC1),
+            'roi':         cv2.cuda_GpuMat(get_roi_mask(frame_h, frame_w)),
+            'lines':       cv2.cuda_GpuMat(),
+        }
+        _cuda['bufs'][(frame_h, frame_w)] = bufs
+
+    return bufs
+
+
+def get_line_list_cuda(frame_in):
+    '''
+    Same as preprocess_image followed by get_line_list, but on the GPU. The intermediate images stay in
+    GPU memory, only the frame is uploaded and only the lines (and the edge image with SHOW_EDGES) are
+    downloaded.
+
+    :param frame_in: Input frame
+
+    :ret lines_list: A list of Lines (in terms of  point coordinates), downscaled by SCALE
+    :ret None: In case no lines were found
+    '''
+
+    stream  = _cuda['stream']
+    frame_h = frame_in.shape[0] // SCALE
+    frame_w = frame_in.shape[1] // SCALE
+    bufs = get_cuda_buffers(frame_h, frame_w)
+
+    gpu_frame = _cuda['frame']
+    gpu_frame.upload(frame_in, stream=stream)
+    if SCALE != 1:
+        gpu_frame = cv2.cuda.resize(gpu_frame, (frame_w, frame_h), dst=bufs['small'],
+                                    interpolation=cv2.INTER_AREA, stream=stream)
+
+    gpu_hsv = cv2.cuda.cvtColor(gpu_frame, cv2.COLOR_BGR2HSV, dst=bufs['hsv'], stream=stream)
+    yellow_mask = cv2.cuda.inRange(gpu_hsv, _thresholds[0], _thresholds[1], dst=bufs['yellow_mask'], stream=stream)
+    white_mask  = cv2.cuda.inRange(gpu_hsv, _thresholds[2], _thresholds[3], dst=bufs['white_mask'], stream=stream)
+    mask = cv2.cuda.bitwise_or(yellow_mask, white_mask, dst=yellow_mask, stream=stream)
+    gpu_grey = cv2.cuda.split(gpu_hsv, bufs['planes'], stream=stream)[2]
+    # The mask is 0 or 255, AND-ing with it blacks out the pixels
+    gpu_grey = cv2.cuda.bitwise_and(gpu_grey, mask, dst=gpu_grey, stream=stream)
+
+    gpu_edge = _cuda['canny'].detect(gpu_grey, bufs['edge'], stream=stream)
+    # Carve out unnecessary region in the frame
+    gpu_edge = cv2.cuda.bitwise_and(gpu_edge, bufs['roi'], dst=gpu_edge, stream=stream)
+
+    gpu_lines = _cuda['hough'].detect(gpu_edge, bufs['lines'], stream=stream)
+    stream.waitForCompletion()
+
+    if SHOW_EDGES:
+        cv2.imshow('w', gpu_edge.download())
+
+    if gpu_lines.empty():
+        return None
+
+    # omit the first dimension
+    return gpu_lines.download().reshape(-1, 4)
+
+
+def classify_lines(lines, right_pts, left_pts):
+    '''
+    Write the end points of lines into the right lane and left lane buffers. Compiled with numba when available.
 
-    for lines in lines_list:
-        slope = get_slope(lines[0], lines[1], lines[2], lines[3])
+    :param lines: An (N,4) int32 array of lines represented by two points
+    :param right_pts, left_pts: Two (M,2) int32 buffers with M >= 2N
+
+    :ret nr, nl: Number of points written to right_pts and left_pts
+    '''
+
+    nr = 0
+    nl = 0
+    for i in range(lines.shape[0]):
+        x1 = lines[i, 0]
+        y1 = lines[i, 1]
+        x2 = lines[i, 2]
+        y2 = lines[i, 3]
+        dx = x2 - x1
+        dy = y2 - y1
         # These lines would not be on either lanes.
-        if -0.2 < slope < 0.2 :
+        if dx == 0 or 5 * abs(dy) < abs(dx):
             continue
-        
-        # Collect points adding to right lane (potentially)
-        if slope > 0:
-            right_lane.append((lines[0], lines[1]))
-            right_lane.append((lines[2], lines[3]))
+
+        # Collect points adding to right lane (potentially), same sign of dx and dy
+        if (dx ^ dy) >= 0:
+            right_pts[nr, 0] = x1
+            right_pts[nr, 1] = y1
+            right_pts[nr + 1, 0] = x2
+            right_pts[nr + 1, 1] = y2
+            nr += 2
         # Collect points adding to the left lane (potentially)
         else:
-            left_lane.append((lines[0], lines[1]))
-            left_lane.append((lines[2], lines[3]))
-   
-    return right_lane, left_lane
+            left_pts[nl, 0] = x1
+            left_pts[nl, 1] = y1
+            left_pts[nl + 1, 0] = x2
+            left_pts[nl + 1, 1] = y2
+            nl += 2
+
+    return nr, nl
+
+
+if njit is not None:
+    classify_lines = njit(cache=True)(classify_lines)
+    # Compile now, so that the first frame does not pay for it
+    classify_lines(np.zeros((1, 4), np.int32), _right_pts, _left_pts)
+
+
+def process_lines(lines_list):
+    '''
+    Distinguish points into rigth lane, left lane and neither(ignore)
+
+    :param lines_list: An (N,4) array of lines represented by two points. Basically the output of cv2.HoughLinesP
+
+    :ret right_lane, left_lane: Two (M,2) arrays. One containing the points forming the right lane and other the left lane.
+                                Both are views of buffers reused across frames, valid until the next call.
+    '''
+
+    global _right_pts, _left_pts
+
+    lines_list = np.ascontiguousarray(lines_list, np.int32)
+    if _right_pts.shape[0] < 2 * lines_list.shape[0]:
+        _right_pts = np.empty((2 * lines_list.shape[0], 2), np.int32)
+        _left_pts  = np.empty((2 * lines_list.shape[0], 2), np.int32)
+
+    if njit is not None:
+        nr, nl = classify_lines(lines_list, _right_pts, _left_pts)
+        return _right_pts[:nr], _left_pts[:nl]
+
+    x1, y1, x2, y2 = lines_list.T
+    dx = (x2 - x1).astype(np.int32)
+    dy = (y2 - y1).astype(np.int32)
+
+    # |slope| >= 0.2 without dividing. Lines with smaller slope would not be on either lanes.
+    keep = np.abs(dy) * 5 >= np.abs(dx)
+    # Vertical lines have no slope, ignore them as well
+    keep &= (dx != 0)
+
+    # Positive slope adds to the right lane (potentially), negative to the left lane.
+    # dx and dy have the same sign when the sign bit of dx ^ dy is clear.
+    positive = (dx ^ dy) >= 0
+    right = keep & positive
+    left  = keep & ~positive
+
+    # Both end points of every line, written straight into the point buffers
+    nr = np.count_nonzero(right)
+    nl = np.count_nonzero(left)
+    _right_pts[:nr]       = lines_list[right, 0:2]
+    _right_pts[nr:2 * nr] = lines_list[right, 2:4]
+    _left_pts[:nl]        = lines_list[left, 0:2]
+    _left_pts[nl:2 * nl]  = lines_list[left, 2:4]
+
+    return _right_pts[:2 * nr], _left_pts[:2 * nl]
+
+
+def fit_line_tls(points, weights=None):
+    '''
+    Weighted total least squares line fit, i.e. along the principal axis of the points
+
+    :param points: An (M,2) float32 array of points
+    :param weights: Weight of every point, None to weigh all points equally
+
+    :ret center, direction: Weighted mean of the points and unit vector along the line
+    '''
 
+    center = np.average(points, axis=0, weights=weights)
+    deviation = points - center
+    scatter = deviation if weights is None else deviation * weights[:, None]
+    _, vectors = np.linalg.eigh(scatter.T.dot(deviation))
+
+    return center, vectors[:, -1]
+
+
+def fit_line(points):
+    '''
+    Fit a line on the points with total least squares, i.e. along the principal axis of the points. It is
+    followed by one reweighting step with L1 weights, so that outliers do not pull the line too much.
+
+    :param points: An (M,2) array of points
+
+    :ret line: An array of four elements [x1,y1,x2,y2] where (x1,y1) is a vector colliniear to the fitted line
+               and (x2,y2) is a point on the line. Same layout as the output of cv2.fitLine
+    '''
+
+    points = np.asarray(points, np.float32)
+    center, direction = fit_line_tls(points)
+
+    # L1 weights from the distance of the points to the line
+    residual = (points[:, 0] - center[0]) * direction[1] - (points[:, 1] - center[1]) * direction[0]
+    weights = 1.0 / np.maximum(np.abs(residual), 1)
+    center, direction = fit_line_tls(points, weights)
+
+    return np.array([direction[0], direction[1], center[0], center[1]], np.float32)
+
+
+def draw_lane(frame_in, lane):
+    '''
+    Draw the lane on the frame from the bottom of the frame up to 65% of its height
+
+    :param frame_in: Frame to draw on
+    :param lane: A list of four elements [x1,y1,x2,y2] where (x1,y1) is a vector colliniear to the given line
+                 and (x2,y2) is a point on the line. Basically output of cv2.fitLine
+    '''
+
+    y1 = frame_in.shape[0]
+    x1 = get_x(y1, lane)
+    y2 = y1 * 0.65
+    x2 = get_x(y2, lane)
+    if x1 is None or x2 is None:
+        return
+
+    cv2.line(frame_in, (int(x1), int(y1)), (int(x2), int(y2)), (0,255,0), 5)
+
+
+def open_video(video_input):
+    '''
+    Open the video, decoding on hardware if HW_DECODE is set. A GStreamer NVDEC pipeline is tried first, then
+    FFmpeg with any available hardware acceleration and finally plain software decoding.
+
+    :param video_input: Path of the video file
+
+    :ret video_in: The opened cv2.VideoCapture
+    '''
+
+    if HW_DECODE:
+        if hasattr(cv2, 'videoio_registry') and cv2.videoio_registry.hasBackend(cv2.CAP_GSTREAMER):
+            video_in = cv2.VideoCapture(GST_PIPELINE.format(video_input), cv2.CAP_GSTREAMER)
+            if video_in.isOpened():
+                return video_in
+
+        if hasattr(cv2, 'CAP_PROP_HW_ACCELERATION'):
+            video_in = cv2.VideoCapture(video_input, cv2.CAP_FFMPEG,
+                                        (cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY))
+            if video_in.isOpened():
+                return video_in
+
+    return cv2.VideoCapture(video_input)
+
+
+def grab_frames(video_in, frames, stop, stride):
+    '''
+    Decode the video in the background and put every stride-th frame in the queue, followed by None at the
+    end of the video. Decoding releases the GIL, so it overlaps with processing in the main thread.
+
+    :param video_in: cv2.VideoCapture to read from
+    :param frames: Queue the decoded frames are put in
+    :param stop: threading.Event set by the main thread once it does not want more frames
+    :param stride: Only every stride-th frame is decoded
+    '''
+
+    frame_idx = 0
+    frame_in = None
+
+    while not stop.is_set():
+        # Advance the video frame by frame. grab() does not decode the frame
+        if not video_in.grab():
+            frame_in = None
+        else:
+            frame_idx += 1
+            if (frame_idx - 1) % stride != 0:
+                continue
+
+            # Decode only the frames which are processed
+            ret, frame_in = video_in.retrieve()
+            if not ret:
+                frame_in = None
+
+        # Wait for space in the queue, unless the main thread is done
+        while not stop.is_set():
+            try:
+                frames.put(frame_in, timeout=0.1)
+                break
+            except Full:
+                pass
+
+        if frame_in is None:
+            return
+
+
+def start_grabber(video_in, stride=STRIDE):
+    '''
+    Start decoding the video in a background thread, see grab_frames
+
+    :param video_in: cv2.VideoCapture to read from
+    :param stride: Only every stride-th frame is decoded
+
+    :ret frames, stop, grabber: The queue of decoded frames, the event stopping the grabber and its thread
+    '''
+
+    frames  = Queue(maxsize=QUEUE_SIZE)
+    stop    = threading.Event()
+    grabber = threading.Thread(target=grab_frames, args=(video_in, frames, stop, stride))
+    grabber.daemon = True
+    grabber.start()
+
+    return frames, stop, grabber
+
+
+def write_frames(video_out, frames):
+    '''
+    Encode and write the frames from the queue until None is taken from it. The cv2.VideoWriter is only
+    used from this thread, so writing never blocks processing in the main thread.
+
+    :param video_out: cv2.VideoWriter to write to
+    :param frames: Queue of the frames to write
+    '''
+
+    while True:
+        frame_out = frames.get()
+        if frame_out is None:
+            return
+
+        video_out.write(frame_out)
+
+
+def start_writer(video_out):
+    '''
+    Start writing video frames in a background thread, see write_frames
+
+    :param video_out: cv2.VideoWriter to write to
+
+    :ret frames, writer: The queue of frames to write and the writer thread
+    '''
+
+    frames = Queue(maxsize=QUEUE_SIZE)
+    writer = threading.Thread(target=write_frames, args=(video_out, frames))
+    writer.daemon = True
+    writer.start()
+
+    return frames, writer
+
+
+def lane_supported(frame_edge, lane):
+    '''
+    Check whether the edge image still supports the lane, i.e. there are enough edge pixels in a thin window
+    along the lane
+
+    :param frame_edge: Edge image, downscaled by SCALE
+    :param lane: Lane in original frame coordinates, as returned by fit_line
+
+    :ret: True if there are at least MIN_LANE_EDGES edge pixels along the lane
+    '''
+
+    frame_h, frame_w = frame_edge.shape
+    y1 = frame_h * SCALE
+    x1 = get_x(y1, lane)
+    y2 = y1 * 0.65
+    x2 = get_x(y2, lane)
+    if x1 is None or x2 is None:
+        return False
+
+    # End points in the downscaled edge image
+    x1, y1, x2, y2 = int(x1 / SCALE), int(y1 / SCALE), int(x2 / SCALE), int(y2 / SCALE)
+
+    # Only look at the bounding rectangle of the window along the lane
+    top    = max(min(y1, y2) - LANE_WINDOW, 0)
+    bottom = min(max(y1, y2) + LANE_WINDOW + 1, frame_h)
+    left   = max(min(x1, x2) - LANE_WINDOW, 0)
+    right  = min(max(x1, x2) + LANE_WINDOW + 1, frame_w)
+    if top >= bottom or left >= right:
+        return False
+
+    # Contiguous view at the start of the window buffer, sized to the rectangle
+    rect_h = bottom - top
+    rect_w = right - left
+    window = get_buffers(frame_h, frame_w)['window'].reshape(-1)[:rect_h * rect_w].reshape(rect_h, rect_w)
+    window[:] = 0
+    cv2.line(window, (x1 - left, y1 - top), (x2 - left, y2 - top), 255, LANE_WINDOW)
+    cv2.bitwise_and(window, frame_edge[top:bottom, left:right], dst=window)
+
+    return cv2.countNonZero(window) >= MIN_LANE_EDGES
+
+
+def smooth_lane(lane, new_lane):
+    '''
+    Moving average of slope and intercept of the lane
+
+    :param lane: Current lane, as returned by fit_line. None if there is none yet.
+    :param new_lane: Lane fitted on the current frame, as returned by fit_line
+
+    :ret lane: Smoothed lane, in the layout of the output of fit_line
+    '''
+
+    if lane is None:
+        return new_lane
+
+    m, c = get_line_props(lane)
+    m_new, c_new = get_line_props(new_lane)
+    if m is None or m_new is None:
+        return new_lane
+
+    m = LANE_ALPHA * m_new + (1 - LANE_ALPHA) * m
+    c = LANE_ALPHA * c_new + (1 - LANE_ALPHA) * c
+
+    return np.array([1, m, 0, c], np.float32)
+
+
+def reset_lanes():
+    '''
+    Forget the current lanes and restart the frame count, call before processing a new video
+    '''
+
+    _lane_state['right'] = None
+    _lane_state['left']  = None
+    _lane_state['age']   = 0
+
+
+def detect_lanes(frame_in):
+    '''
+    Detect the right and left lane in the frame. The Hough transform only runs every HOUGH_INTERVAL-th frame,
+    or when the edges of the frame no longer support the current lanes. Lanes are smoothed over frames and
+    kept if a frame yields none.
+
+    :param frame_in: Input frame
+
+    :ret right_fit, left_fit: Lanes in the frame, as returned by fit_line. None if there is none yet.
+    '''
+
+    right_fit = _lane_state['right']
+    left_fit  = _lane_state['left']
+    age = _lane_state['age']
+    _lane_state['age'] = age + 1
+
+    if _cuda is not None:
+        lines_list = get_line_list_cuda(frame_in)
+    else:
+        # preprocess input frame
+        frame_ = preprocess_image(frame_in)
+
+        # Keep the current lanes while the edges support them
+        if (age % HOUGH_INTERVAL != 0 and right_fit is not None and left_fit is not None
+                and lane_supported(frame_, right_fit) and lane_supported(frame_, left_fit)):
+            return right_fit, left_fit
+
+        # Get list of lines with hough transform on frame 
+        lines_list = get_line_list(frame_)
+
+    # check if lines_list is not empty, otherwise keep the lanes from the previous frame
+    if lines_list is not None:
+        # Map the lines back to the original frame coordinates
+        lines_list *= SCALE
+        right_lane, left_lane = process_lines(lines_list)
+
+        if len(right_lane) > 0:
+            _lane_state['right'] = smooth_lane(right_fit, fit_line(right_lane))
+
+        if len(left_lane) > 0:
+            _lane_state['left']  = smooth_lane(left_fit, fit_line(left_lane))
+
+    return _lane_state['right'], _lane_state['left']
+
+
+def render_offline(video_input, video_output):
+    '''
+    Detect the lanes in the video without displaying it and write the annotated video. Every frame is written,
+    lanes are detected on every STRIDE-th frame and drawn on the frames in between as well.
+
+    :param video_input: Path of the input video
+    :param video_output: Path of the annotated output video
+    '''
+
+    video_in  = open_video(video_input)
+    fps       = video_in.get(cv2.CAP_PROP_FPS)
+    size      = (int(video_in.get(cv2.CAP_PROP_FRAME_WIDTH)), int(video_in.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    video_out = cv2.VideoWriter(video_output, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    frames_out, writer = start_writer(video_out)
+
+    # Every frame ends up in the output, so all of them are decoded
+    frames, stop, grabber = start_grabber(video_in, stride=1)
+    reset_lanes()
+
+    frame_idx = 0
+    right_fit = None
+    left_fit  = None
+    while True:
+        frame_in = frames.get()
+        if frame_in is None:
+            break
+
+        if frame_idx % STRIDE == 0:
+            right_fit, left_fit = detect_lanes(frame_in)
+
+        if right_fit is not None:
+            draw_lane(frame_in, right_fit)
+        if left_fit is not None:
+            draw_lane(frame_in, left_fit)
+
+        frames_out.put(frame_in)
+        frame_idx += 1
+
+    stop.set()
+    grabber.join()
+    video_in.release()
+
+    frames_out.put(None)
+    writer.join()
+    video_out.release()
 
 
 if __name__ == '__main__':
@@ -190,77 +892,68 @@ if __name__ == '__main__':
     Read Video frame by frame and call hepler functions.
     '''
     
-    if len(sys.argv) > 1:
-        # Expcet Video Filename in argv[1]
-        video_input = sys.argv[1]
-    else:
-        # use default video in case there is no input from console
-        video_input = VIDEO_INPUT
-
-    video_in  = cv2.VideoCapture(video_input)
+    parser = argparse.ArgumentParser(description='Lane detection with line detection in Hough space')
+    # use default video in case there is no input from console
+    parser.add_argument('video', nargs='?', default=VIDEO_INPUT, help='input video file')
+    parser.add_argument('--offline', metavar='OUT', help='write the annotated video to OUT instead of displaying it')
+    args = parser.parse_args()
+    video_input = args.video
+
+    # Make sure the SIMD (AVX2) code paths of OpenCV are used. A single OpenCV thread avoids thread pool
+    # overhead on frames this small, decoding already runs in its own thread.
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(1)
+    if hasattr(cv2, 'getCPUFeaturesLine') and 'AVX2' not in cv2.getCPUFeaturesLine():
+        print("AVX2 is not available, OpenCV uses slower code paths")
+
+    if args.offline:
+        SHOW_EDGES = 0
+        render_offline(video_input, args.offline)
+        sys.exit()
+
+    video_in  = open_video(video_input)
     if video_in.isOpened():
         FRAME_WIDTH  = video_in.get(3)
         FRAME_HEIGHT = video_in.get(4)
-        print FRAME_HEIGHT, FRAME_WIDTH
+        print(f"{FRAME_HEIGHT} {FRAME_WIDTH}")
 
     if DUMP:
         fourcc = cv2.VideoWriter_fourcc(*'DIVX')
         video_out = cv2.VideoWriter('output.avi', fourcc, 24.0, (int(FRAME_WIDTH), int(FRAME_HEIGHT))) 
+        frames_out, writer = start_writer(video_out)
 
-    while(video_in.isOpened()):
-        # Read the video frame by frame
-        ret, frame_in = video_in.read()
-        if ret:
-            # preprocess input frame
-            frame_ = preprocess_image(frame_in)
+    # Decode in a background thread, display stays in the main thread
+    frames, stop, grabber = start_grabber(video_in)
+    reset_lanes()
 
-            # Get list of lines with hough transform on frame 
-            lines_list = get_line_list(frame_)
-    
-            # check if lines_list is not empty
-            if np.any(np.equal(lines_list, None)):
-                # print "skipping frame"
-                continue
-            else:
-                right_lane, left_lane = process_lines(lines_list)
-
-            # Draw the right lane on the original frame
-            if len(right_lane) is not 0:
-                right_lane = cv2.fitLine(np.asarray(right_lane), cv2.DIST_L1, 0, 0.01, 0.01)
-                
-                y1 = FRAME_HEIGHT
-                x1 = get_x(y1, right_lane)
-                y2 = FRAME_HEIGHT * 0.65
-                x2 = get_x(y2, right_lane)
-                if x1 is None or x2 is None:
-                    continue
-
-                cv2.line(frame_in, (int(x1), int(y1)), (int(x2), int(y2)), (0,255,0), 5)
-            
-            # Draw the left lane on the original frame
-            if len(left_lane) is not 0:
-                left_lane  = cv2.fitLine(np.asarray(left_lane), cv2.DIST_L1, 0, 0.01, 0.01)
-                
-                y1 = FRAME_HEIGHT
-                x1 = get_x(y1, left_lane)
-                y2 = FRAME_HEIGHT * 0.65
-                x2 = get_x(y2, left_lane)
-                if x1 is None or x2 is None:
-                    continue
-
-                cv2.line(frame_in, (int(x1), int(y1)), (int(x2), int(y2)), (0,255,0), 5)
-
-            cv2.imshow('output', frame_in)
-            if DUMP:
-                video_out.write(frame_in)
-
-            if cv2.waitKey(FRAME_DELAY) & 0xFF == ord('q'):
-                break 
-        else:
-            print "Nothing to read"
+    while True:
+        frame_in = frames.get()
+        if frame_in is None:
+            print("Nothing to read")
             break
 
-    # When everything done, release the capture
+        right_fit, left_fit = detect_lanes(frame_in)
+
+        # Draw the lanes on the original frame
+        if right_fit is not None:
+            draw_lane(frame_in, right_fit)
+        if left_fit is not None:
+            draw_lane(frame_in, left_fit)
+
+        cv2.imshow('output', frame_in)
+        if DUMP:
+            frames_out.put(frame_in)
+
+        if cv2.waitKey(FRAME_DELAY) & 0xFF == ord('q'):
+            break 
+
+    # When everything done, stop the grabber and release the capture
+    stop.set()
+    grabber.join()
     video_in.release()
+    if DUMP:
+        frames_out.put(None)
+        writer.join()
+        video_out.release()
     cv2.destroyAllWindows()
 